@@ -5,8 +5,6 @@ from pipelineUtils.blob_functions import get_blob_content, write_to_blob
 from pipelineUtils.azure_openai import run_prompt
 import base64
 import json
-import fitz # PyMuPDF
-from PyPDF2 import PdfReader, PdfWriter  # 👈 for PDF trimming
 import logging
 
 from pipelineUtils.prompts import load_prompts
@@ -28,6 +26,7 @@ def convert_to_base64_images(blob_input: dict):
     if blob_name.lower().endswith('.pdf'):
         # Process PDF: Convert each page to base64-encoded image
         try:
+            import fitz # PyMuPDF, imported on first PDF rather than at host cold start
 
             base64_images = []
             with fitz.open(stream=blob_content, filetype='pdf') as doc:
@@ -2,17 +2,12 @@ import azure.durable_functions as df
 import logging
 from pipelineUtils.blob_functions import list_blobs, get_blob_content, write_to_blob
 from pipelineUtils import get_month_date
-# Libraries used in the future Document Processing client code
-from azure.identity import DefaultAzureCredential
-from azure.ai.documentintelligence import DocumentIntelligenceClient
-from azure.ai.documentintelligence.models import AnalyzeResult, AnalyzeDocumentRequest
 import base64
 import json
 import os
-import requests
 
-from configuration import Configuration
-config = Configuration()
+from configuration import get_configuration
+config = get_configuration()
 
 
 name = "runDocIntel"
@@ -34,6 +29,9 @@ def extract_text_from_blob(blob_input: dict):
     endpoint = config.get_value("AI_SERVICES_ENDPOINT")
 
     try:
+        # Imported on first use so the SDK does not load on every host cold start
+        from azure.ai.documentintelligence import DocumentIntelligenceClient
+        from azure.ai.documentintelligence.models import AnalyzeResult, AnalyzeDocumentRequest
     
         client = DocumentIntelligenceClient(
             endpoint=endpoint, credential=config.credential
@@ -1,89 +1,371 @@
 import azure.durable_functions as df
 
-import requests
-import time
+import asyncio
 import logging
+import random
+import re
+import time
+from contextlib import asynccontextmanager
+
+import httpx
+import ijson
+import orjson
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+
+from configuration import get_configuration
+
+config = get_configuration()
+credential = config.credential
 
-from configuration import Configuration
+ENDPOINT = config.get_value("AI_SERVICES_ENDPOINT").rstrip("/")
+API_VERSION = "2025-10-15"
+SUBMIT_URL = f"{ENDPOINT}/speechtotext/transcriptions:submit?api-version={API_VERSION}"
 
 name = "speechToText"
 bp = df.Blueprint()
 
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+# Azure AD tokens are valid for ~1 hour; refresh only when close to expiry
+# instead of walking the credential chain on every blob.
+_token_cache = {"token": None, "expires_on": 0}
+
+# Intermediate polls only need the status, so it is pulled out of the raw body
+# and the full payload is parsed once the job reaches a terminal state.
+_STATUS_RE = re.compile(rb'"status"\s*:\s*"(\w+)"')
+_RUNNING_STATUSES = frozenset({b'NotStarted', b'Running'})
+
+# Shared HTTP/2 client, created lazily on the worker's event loop and reused
+# across invocations. Concurrent submits, polls and downloads to the Speech
+# endpoint are multiplexed over one connection instead of paying a new
+# TCP + TLS handshake per request, and repeated headers are HPACK-compressed.
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+            timeout=httpx.Timeout(30.0),
+            headers={'Content-Type': 'application/json'}
+        )
+    return _client
+
+
+# Transient responses are retried at the HTTP layer so a throttled poll does
+# not fail the activity and resubmit the whole job through Durable retries.
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+_backoff = wait_exponential(multiplier=0.5, max=30)
+
+
+class TransientHTTPError(Exception):
+    def __init__(self, method, url, status, retry_after=None):
+        super().__init__(f"{method} {url} returned {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def _retry_wait(retry_state):
+    """Wait as long as Retry-After asks, otherwise back off exponentially."""
+    retry_after = getattr(retry_state.outcome.exception(), 'retry_after', None)
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return _backoff(retry_state)
+
+
+@retry(
+    retry=retry_if_exception_type((TransientHTTPError, httpx.TransportError)),
+    wait=_retry_wait,
+    stop=stop_after_attempt(6),
+    reraise=True
+)
+async def _send(method, url, **kwargs):
+    """Send a request on the shared client, retrying 429/5xx responses.
+
+    The response is returned unread (streamed); callers close it through
+    _request.
+    """
+    client = get_client()
+    response = await client.send(client.build_request(method, url, **kwargs), stream=True)
+    if response.status_code in RETRY_STATUSES:
+        retry_after = response.headers.get("Retry-After")
+        await response.aclose()
+        # Drop the query string so SAS tokens are not logged
+        path = url.split('?', 1)[0]
+        logging.warning(f"{method} {path} returned {response.status_code}, retrying")
+        raise TransientHTTPError(method, path, response.status_code, retry_after)
+    return response
+
 
-def wait_for_transcription(transcription_url, headers, check_interval=10):
-    """Poll the transcription status until it's complete"""
+@asynccontextmanager
+async def _request(method, url, **kwargs):
+    response = await _send(method, url, **kwargs)
+    try:
+        yield response
+    finally:
+        await response.aclose()
+
+
+class _StreamReader:
+    """Async file-like view of a streamed response, as ijson expects."""
+
+    def __init__(self, response):
+        self._chunks = response.aiter_bytes()
+
+    async def read(self, size=-1):
+        if size == 0:
+            return b""
+        try:
+            return await self._chunks.__anext__()
+        except StopAsyncIteration:
+            return b""
+
+
+def _get_token():
+    now = time.time()
+    if _token_cache["expires_on"] - now < 300:
+        t = credential.get_token(COGNITIVE_SERVICES_SCOPE)
+        _token_cache.update(token=t.token, expires_on=t.expires_on)
+    return _token_cache["token"]
+
+
+async def wait_for_transcription(transcription_url, headers, check_interval=1.0, max_interval=30.0):
+    """Poll the transcription status until it's complete.
+
+    The wait between polls starts at check_interval and doubles (with jitter)
+    up to max_interval. A Retry-After header from the service takes precedence.
+    """
+    delay = check_interval
     while True:
-        status_response = requests.get(transcription_url, headers=headers)
-        status = status_response.json()
-        
+        async with _request("GET", transcription_url, headers=headers) as status_response:
+            body = await status_response.aread()
+            match = _STATUS_RE.search(body)
+            if match and match.group(1) in _RUNNING_STATUSES:
+                status = {'status': match.group(1).decode()}
+            else:
+                status = orjson.loads(body)
+            retry_after = status_response.headers.get("Retry-After")
+
         current_status = status['status']
         print(f"Status: {current_status}")
         
         if current_status == 'Succeeded':
             print("Transcription completed successfully!")
+            # Resolve the transcript URLs while the pooled connection is warm
+            status['contentUrls'] = await _get_content_urls(status['links']['files'], headers)
             return status
         elif current_status == 'Failed':
             print("Transcription failed!")
             print(f"Error: {status.get('properties', {}).get('error', 'Unknown error')}")
             return status
         else:
-            print(f"Waiting {check_interval} seconds before checking again...")
-            time.sleep(check_interval)
+            wait = _next_delay(delay, retry_after)
+            print(f"Waiting {wait:.1f} seconds before checking again...")
+            await asyncio.sleep(wait)
+            delay = min(max_interval, delay * 2)
+
+
+async def _get_content_urls(files_url, headers):
+    """Return the contentUrl of each transcription result file (one per input).
+
+    The listing also contains the TranscriptionReport, so only Transcription
+    files are requested. Large batches are paged, so @nextLink is followed.
+    """
+    content_urls = []
+    # httpx replaces the query when params= is given, so merge the filter into
+    # the files URL to keep its api-version
+    url = str(httpx.URL(files_url).copy_merge_params({"filter": "kind eq 'Transcription'"}))
+    while url:
+        async with _request("GET", url, headers=headers) as files_response:
+            page = orjson.loads(await files_response.aread())
+        content_urls.extend(f['links']['contentUrl'] for f in page['values'] if f.get('kind') == 'Transcription')
+        # nextLink already carries the api-version, filter and paging query
+        url = page.get('@nextLink')
+    return content_urls
+
+
+def _next_delay(delay, retry_after=None):
+    """Return the wait before the next poll, honoring a Retry-After header."""
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return delay * random.uniform(0.8, 1.2)
+
+
+def _auth_headers():
+    # Content-Type is a client default; the bearer token is passed per
+    # request because the SAS contentUrl must be fetched without it
+    return {
+        "Authorization": f"Bearer {_get_token()}",
+    }
+
+
+async def submit_transcription(blob_uris, instance_id=None):
+    """Submit a batch transcription job for blob_uris and return its status URL.
+
+    instance_id is stored in the job's customProperties so a completion web
+    hook can be routed back to the waiting orchestration.
+    """
+    payload = {
+        "displayName": "Transcription",
+        "locale": "en-US",
+        "contentUrls": list(blob_uris),
+        "properties": {
+            "wordLevelTimestampsEnabled": False,
+            "displayFormWordLevelTimestampsEnabled": False,
+            "punctuationMode": "DictatedAndAutomatic",
+            "profanityFilterMode": "Masked",
+            "timeToLiveHours": 48
+        }
+    }
+    if instance_id:
+        payload["customProperties"] = {"instanceId": instance_id}
+
+    logging.info(f"Submitting transcription request with payload: {payload}")
+    async with _request("POST", SUBMIT_URL, json=payload, headers=_auth_headers()) as response:
+        return orjson.loads(await response.aread())['self']
+
+
+async def _wait_for_success(transcription_url):
+    final_status = await wait_for_transcription(transcription_url, _auth_headers())
+
+    if final_status['status'] != 'Succeeded':
+        raise RuntimeError(f"Transcription failed: {final_status.get('properties', {}).get('error', 'Unknown error')}")
+    return final_status
+
+
+async def _fetch_transcript(content_url):
+    """Stream a result file and return its (source, display text).
+
+    Only the source and the first combined phrase are kept, so the bulky
+    per-word recognizedPhrases array is never materialized.
+    """
+    source, text = None, None
+    async with _request("GET", content_url) as content_response:
+        async for prefix, event, value in ijson.parse_async(_StreamReader(content_response)):
+            if prefix == 'source' and event == 'string':
+                source = value
+            elif prefix == 'combinedRecognizedPhrases.item.display' and text is None:
+                text = value
+            if source is not None and text is not None:
+                break
+    return source, text
+
+
+async def get_transcription_text(transcription_url):
+    """Wait for the job at transcription_url to finish and return its text."""
+    final_status = await _wait_for_success(transcription_url)
+    _, text = await _fetch_transcript(final_status['contentUrls'][0])
+    if text is None:
+        raise RuntimeError("Transcription result has no recognized phrases")
+    return text
+
+
+async def get_transcription_texts(transcription_url):
+    """Wait for a multi-file job to finish and return its texts keyed by source URL.
+
+    A file with no recognized phrases maps to None, so its orchestration takes
+    the same single-blob path (and error) as get_transcription_text.
+    """
+    final_status = await _wait_for_success(transcription_url)
+    transcripts = await asyncio.gather(*(_fetch_transcript(url) for url in final_status['contentUrls']))
+    return dict(transcripts)
+
+
+async def get_transcription_instance_id(transcription_url):
+    """Return the orchestration instance id recorded on a transcription job."""
+    async with _request("GET", transcription_url, headers=_auth_headers()) as response:
+        transcription = orjson.loads(await response.aread())
+    return transcription.get('customProperties', {}).get('instanceId')
 
 
 @bp.function_name(name)
 @bp.activity_trigger(input_name="blob_input")
-def run(blob_input: dict):
+async def run(blob_input: dict):
     # Parse Arguments
     try: 
         blob_name = blob_input.get('name')
         container = blob_input.get('container')
         blob_uri = blob_input.get('uri')
 
+        logging.info(f"Transcribing blob: {blob_name} in container: {container}")
+        transcription_url = await submit_transcription([blob_uri])
 
-        config = Configuration()
-        credential = config.credential
-        token = credential.get_token("https://cognitiveservices.azure.com/.default").token
-        
-        endpoint = config.get_value("AI_SERVICES_ENDPOINT")
-        api_version = "2025-10-15"
-        url = f"{endpoint}/speechtotext/transcriptions:submit?api-version={api_version}"
+        # Wait for completion
+        full_text = await get_transcription_text(transcription_url)
 
-        headers = {
-            'Content-Type': 'application/json',
-            "Authorization": f"Bearer {token}",
-        }
+    except Exception as e:
+        logging.error(f"Error during speech-to-text processing: {e}")
+        raise  # Re-raise to allow Durable Functions to retry
 
-        payload = {
-            "displayName": "Transcription",
-            "locale": "en-US",
-            "contentUrls": [blob_uri], #
-            "properties": {
-                "wordLevelTimestampsEnabled": False,
-                "displayFormWordLevelTimestampsEnabled": False,
-                "punctuationMode": "DictatedAndAutomatic",
-                "profanityFilterMode": "Masked",
-                "timeToLiveHours": 48
-            }
-        }
+    return full_text
 
-        logging.info(f"Submitting transcription request for blob: {blob_name} in container: {container} with payload: {payload}")
-        response = requests.post(url, json=payload, headers=headers)
-        transcription_url = response.json()['self']
 
-        # Wait for completion
-        final_status = wait_for_transcription(transcription_url, headers)
+@bp.function_name("submitTranscription")
+@bp.activity_trigger(input_name="blob_input")
+async def submit(blob_input: dict):
+    """Submit the transcription job only; completion arrives via web hook."""
+    try:
+        logging.info(f"Submitting transcription for blob: {blob_input.get('name')} in container: {blob_input.get('container')}")
+        return await submit_transcription([blob_input.get('uri')], blob_input.get('instance_id'))
 
-        files_url = final_status['links']['files']
+    except Exception as e:
+        logging.error(f"Error submitting speech-to-text job: {e}")
+        raise  # Re-raise to allow Durable Functions to retry
 
-        files_response = requests.get(files_url, headers=headers)
-        content_url = files_response.json()['values'][0]['links']['contentUrl']
-        content_response = requests.get(content_url).json()
-        # content_response.json()
-        full_text = content_response['combinedRecognizedPhrases'][0]['display']
+
+@bp.function_name("getTranscriptionText")
+@bp.activity_trigger(input_name="args")
+async def get_text(args: dict):
+    """Fetch the transcript of a finished (or finishing) transcription job."""
+    try:
+        return await get_transcription_text(args['transcription_url'])
 
     except Exception as e:
-        logging.error(f"Error during speech-to-text processing: {e}")
+        logging.error(f"Error fetching speech-to-text result: {e}")
         raise  # Re-raise to allow Durable Functions to retry
 
-    return full_text
+
+@bp.function_name("speechToTextBatch")
+@bp.activity_trigger(input_name="batch")
+@bp.durable_client_input(client_name="client")
+async def run_batch(batch: list, client):
+    """Transcribe several queued blobs in one job and notify each orchestration.
+
+    Each batch item carries the blob uri and the instance_id of the
+    process_blob orchestration waiting on the stt_batch_done event.
+    """
+    try:
+        logging.info(f"Submitting batched transcription for {len(batch)} blobs")
+        transcription_url = await submit_transcription([item['uri'] for item in batch])
+        texts = await get_transcription_texts(transcription_url)
+
+        for item in batch:
+            await client.raise_event(
+                item['instance_id'],
+                "stt_batch_done",
+                {"text_result": texts.get(item['uri'])}
+            )
+
+    except Exception as e:
+        logging.error(f"Error during batched speech-to-text processing: {e}")
+        raise  # Re-raise to allow Durable Functions to retry
+
+    return len(batch)
+
+
+@bp.function_name("releaseTranscriptionBatch")
+@bp.activity_trigger(input_name="batch")
+@bp.durable_client_input(client_name="client")
+async def release_batch(batch: list, client):
+    """Notify each orchestration of a failed batch so it transcribes on its own."""
+    for item in batch:
+        await client.raise_event(item['instance_id'], "stt_batch_done", {"text_result": None})
+    return len(batch)
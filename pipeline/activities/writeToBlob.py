@@ -3,8 +3,8 @@ import logging
 from pipelineUtils.blob_functions import list_blobs, get_blob_content, write_to_blob
 import os
 
-from configuration import Configuration
-config = Configuration()
+from configuration import get_configuration
+config = get_configuration()
 
 FINAL_OUTPUT_CONTAINER = config.get_value("FINAL_OUTPUT_CONTAINER")
 
@@ -19,7 +19,8 @@ def write_to_blob_activity(args: dict):
   """
   Writes the JSON bytes to a blob storage.
   Args:
-      args (dict): A dictionary containing the blob name and JSON bytes.
+      args (dict): A dictionary containing the blob name and JSON bytes, and
+          optionally output_blob to override the default <source>-output.json name.
   """
   try:
         # Parse arguments
@@ -30,15 +31,16 @@ def write_to_blob_activity(args: dict):
       args['json_bytes'] = json_str.encode('utf-8')
 
       sourcefile = os.path.splitext(os.path.basename(blob_name))[0]
-      logging.info(f"writeToBlob.py: Writing output to blob {sourcefile}-output.json with source file {sourcefile} and FINAL_OUTPUT_CONTAINER {final_output_container}")
-      result = write_to_blob(final_output_container, f"{sourcefile}-output.json", args['json_bytes'])
+      output_blob = args.get('output_blob') or f"{sourcefile}-output.json"
+      logging.info(f"writeToBlob.py: Writing output to blob {output_blob} with source file {sourcefile} and FINAL_OUTPUT_CONTAINER {final_output_container}")
+      result = write_to_blob(final_output_container, output_blob, args['json_bytes'])
       logging.info(f"writeToBlob.py: Result of write_to_blob: {result}")
       if result:
           logging.info(f"writeToBlob.py: Successfully wrote output to blob {blob_name}")
           return {
               "success": True,
               "blob_name": blob_name,
-              "output_blob": f"{sourcefile}-output.json"
+              "output_blob": output_blob
           }
       else:
           logging.error(f"Failed to write output to blob {blob_name}")
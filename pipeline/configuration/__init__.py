@@ -1 +1 @@
-from .configuration import Configuration
\ No newline at end of file
+from .configuration import Configuration, get_configuration
\ No newline at end of file
@@ -1,5 +1,6 @@
 import os
 import logging
+from functools import lru_cache
 from azure.identity import DefaultAzureCredential
 from azure.appconfiguration.provider import (
     AzureAppConfigurationKeyVaultOptions,
@@ -142,4 +143,10 @@ class Configuration:
 
     def read_env_boolean(self, var_name, default=False):
         value = self.get_value(var_name, str(default)).strip().lower()
-        return value in ['true', '1', 'yes']
\ No newline at end of file
+        return value in ['true', '1', 'yes']
+
+
+@lru_cache(maxsize=None)
+def get_configuration() -> Configuration:
+    """Return the shared Configuration so App Configuration is loaded once per worker."""
+    return Configuration()
@@ -1,5 +1,10 @@
 import os
+import base64
+import json
+import hashlib
+import hmac
 import logging
+from datetime import timedelta
 
 import azure.functions as func
 import azure.durable_functions as df
@@ -7,15 +12,63 @@ from azure.durable_functions import RetryOptions
 
 
 from activities import runDocIntel, callAiFoundry, writeToBlob, speechToText, callFoundryMultiModal
-from configuration import Configuration
+from configuration import get_configuration
 
 from pipelineUtils.blob_functions import BlobMetadata
 
-config = Configuration()
+config = get_configuration()
 
 # NEXT_STAGE = config.get_value("NEXT_STAGE")
 FINAL_OUTPUT_CONTAINER = config.get_value("FINAL_OUTPUT_CONTAINER")
 
+# Feature flags are read once at cold start rather than on every orchestrator replay
+AOAI_MULTI_MODAL = config.read_env_boolean("AOAI_MULTI_MODAL")
+AI_VISION_ENABLED = config.read_env_boolean("AI_VISION_ENABLED")
+SPEECH_CALLBACK_ENABLED = config.read_env_boolean("SPEECH_CALLBACK_ENABLED")
+SPEECH_BATCHING_ENABLED = config.read_env_boolean("SPEECH_BATCHING_ENABLED")
+WRITE_TEXT_RESULT = config.read_env_boolean("WRITE_TEXT_RESULT")
+
+# Audio blobs queued in the PendingAudioBatch entity are flushed on this
+# schedule, at most SPEECH_BATCH_SIZE blobs per transcription job
+SPEECH_BATCH_SCHEDULE = "*/30 * * * * *"
+SPEECH_BATCH_SIZE = int(config.get_value("SPEECH_BATCH_SIZE", "20"))
+PENDING_AUDIO_BATCH = df.EntityId("PendingAudioBatch", "bronze")
+# A single, reused flush instance keeps flushes from overlapping and bounds
+# the task hub to one flush history
+FLUSH_AUDIO_BATCH_INSTANCE_ID = "flush_audio_batch"
+
+# How long a queued audio orchestration waits for stt_batch_done (next flush
+# plus the batched job) before transcribing the blob on its own
+SPEECH_BATCH_TIMEOUT = timedelta(hours=1)
+
+# How long an audio orchestration waits for the Speech completion web hook
+# before falling back to polling the transcription itself
+SPEECH_CALLBACK_TIMEOUT = timedelta(hours=2)
+
+# Shared secret the web hook was registered with; when set, notifications must
+# carry a matching X-MicrosoftSpeechServices-Signature
+SPEECH_CALLBACK_SECRET = config.get_value("SPEECH_CALLBACK_SECRET", "")
+
+# Orchestrators replay on every event, so replay-invariant values live at
+# module scope instead of being rebuilt inside process_blob.
+FILE_TYPES_BY_EXTENSION = {
+    **dict.fromkeys(('.wav', '.mp3', '.opus', '.ogg', '.flac', '.wma', '.aac', '.webm'), "audio"),
+    **dict.fromkeys(('.pdf', '.docx', '.doc', '.xlsx', '.pptx', '.jpg', '.jpeg', '.png', '.tiff', '.bmp'), "document"),
+}
+
+# Text extraction activity for each supported file type
+TEXT_EXTRACTION_ACTIVITIES = {
+    "audio": "speechToText",
+    "document": "runDocIntel",
+}
+
+# Define retry options for handling transient failures
+# Note: backoff_coefficient requires azure-functions-durable >= 1.3.0
+RETRY_OPTIONS = RetryOptions(
+    first_retry_interval_in_milliseconds=5000,    # 5 seconds initial wait
+    max_number_of_attempts=5                       # More attempts for rate limit scenarios
+)
+
 app = df.DFApp(http_auth_level=func.AuthLevel.FUNCTION)
 
 
@@ -111,6 +164,142 @@ async def start_orchestrator_http(req: func.HttpRequest, client):
     return response
 
 
+# Speech batch transcription web hook (transcriptionCompletion events).
+# Register {function url}/api/speech_callback?code=<key> as a web hook on the
+# AI Services resource and set SPEECH_CALLBACK_ENABLED=true.
+def _valid_speech_signature(req: func.HttpRequest) -> bool:
+    """Check the web hook HMAC-SHA256 signature when a secret is configured."""
+    if not SPEECH_CALLBACK_SECRET:
+        return True
+    signature = req.headers.get("X-MicrosoftSpeechServices-Signature", "")
+    digest = hmac.new(SPEECH_CALLBACK_SECRET.encode("utf-8"), req.get_body(), hashlib.sha256).digest()
+    # Compare bytes: compare_digest raises TypeError on non-ASCII str input
+    return hmac.compare_digest(signature.encode("utf-8"), base64.b64encode(digest))
+
+
+@app.route(route="speech_callback", methods=["POST"])
+@app.durable_client_input(client_name="client")
+async def speech_callback(req: func.HttpRequest, client):
+    """
+    Relays a Speech transcription completion to the waiting orchestration.
+
+    args:
+        req (func.HttpRequest): Web hook notification whose body contains the transcription "self" URL.
+        client (DurableOrchestrationClient): The Durable Functions client.
+    response:
+        func.HttpResponse: The HTTP response object.
+    """
+    # Web hook registration handshake: echo the validation token back
+    validation_token = req.params.get("validationToken")
+    if validation_token:
+        return func.HttpResponse(validation_token, status_code=200)
+
+    if not _valid_speech_signature(req):
+        return func.HttpResponse("Invalid signature.", status_code=401)
+
+    try:
+        body = req.get_json()
+        transcription_url = body["self"]
+    except (ValueError, KeyError):
+        return func.HttpResponse("Invalid JSON.", status_code=400)
+
+    # The lookup below sends our bearer token, so only follow URLs on our own
+    # Speech endpoint
+    if not isinstance(transcription_url, str) or not transcription_url.startswith(f"{speechToText.ENDPOINT}/speechtotext/"):
+        logging.warning("Rejected speech callback for a transcription outside AI_SERVICES_ENDPOINT")
+        return func.HttpResponse("Invalid transcription URL.", status_code=400)
+
+    try:
+        instance_id = await speechToText.get_transcription_instance_id(transcription_url)
+    except Exception as e:
+        # Acknowledge so Speech stops redelivering; the orchestration falls back
+        # to polling after SPEECH_CALLBACK_TIMEOUT
+        logging.error(f"Failed to look up transcription {transcription_url}: {e}")
+        return func.HttpResponse(status_code=200)
+
+    if not instance_id:
+        logging.warning(f"No orchestration recorded for transcription {transcription_url}")
+        return func.HttpResponse(status_code=200)
+
+    await client.raise_event(instance_id, "stt_done", {"transcription_url": transcription_url})
+    logging.info(f"Raised stt_done for orchestration {instance_id}")
+    return func.HttpResponse(status_code=200)
+
+
+# Audio micro-batching (only registered when SPEECH_BATCHING_ENABLED, so the
+# timer does not keep the app awake when the feature is off)
+if SPEECH_BATCHING_ENABLED:
+    # Durable entity queueing audio blobs until the next batch flush
+    @app.entity_trigger(context_name="context")
+    def PendingAudioBatch(context: df.DurableEntityContext):
+        pending = context.get_state(lambda: [])
+        operation = context.operation_name
+
+        if operation == "add":
+            pending.append(context.get_input())
+            context.set_result(len(pending))
+        elif operation == "take":
+            max_items = context.get_input()
+            context.set_result(pending[:max_items])
+            pending = pending[max_items:]
+
+        context.set_state(pending)
+
+
+    @app.function_name(name="flush_audio_batch_timer")
+    @app.timer_trigger(arg_name="timer", schedule=SPEECH_BATCH_SCHEDULE, run_on_startup=False)
+    @app.durable_client_input(client_name="client")
+    async def flush_audio_batch_timer(timer: func.TimerRequest, client):
+        state = await client.read_entity_state(PENDING_AUDIO_BATCH)
+        pending = state.entity_state if state.entity_exists else None
+        if isinstance(pending, str):
+            pending = json.loads(pending)
+        if not pending:
+            return
+
+        status = await client.get_status(FLUSH_AUDIO_BATCH_INSTANCE_ID)
+        if status and status.runtime_status in (df.OrchestrationRuntimeStatus.Running, df.OrchestrationRuntimeStatus.Pending):
+            logging.info("Previous audio batch flush still running; skipping")
+            return
+
+        instance_id = await client.start_new("flush_audio_batch", instance_id=FLUSH_AUDIO_BATCH_INSTANCE_ID)
+        logging.info(f"Started audio batch flush {instance_id} for {len(pending)} queued blobs")
+
+
+    @app.function_name(name="flush_audio_batch")
+    @app.orchestration_trigger(context_name="context")
+    def flush_audio_batch(context):
+        # Drain the queue in chunks of SPEECH_BATCH_SIZE, one transcription job per chunk
+        batches = []
+        while True:
+            batch = yield context.call_entity(PENDING_AUDIO_BATCH, "take", SPEECH_BATCH_SIZE)
+            if not batch:
+                break
+            batches.append(batch)
+            if len(batch) < SPEECH_BATCH_SIZE:
+                break
+
+        # All jobs are scheduled up front and run in parallel; each is awaited
+        # separately so one failed batch does not hide the others
+        tasks = [context.call_activity_with_retry("speechToTextBatch", RETRY_OPTIONS, batch) for batch in batches]
+        failed = []
+        for batch, task in zip(batches, tasks):
+            try:
+                yield task
+            except Exception as e:
+                logging.error(f"Batched transcription of {len(batch)} blobs failed: {e}")
+                failed.append(batch)
+
+        # The items have already left the queue, so release their orchestrations
+        # to the single-blob fallback now rather than after SPEECH_BATCH_TIMEOUT
+        if failed:
+            yield context.task_all([
+                context.call_activity_with_retry("releaseTranscriptionBatch", RETRY_OPTIONS, batch)
+                for batch in failed
+            ])
+        return len(batches)
+
+
 #Sub orchestrator
 @app.function_name(name="process_blob")
 @app.orchestration_trigger(context_name="context")
@@ -120,22 +309,11 @@ def process_blob(context):
     logging.info(f"Process Blob sub Orchestration - Processing blob_metadata: {blob_input} with sub orchestration id: {sub_orchestration_id}")
     # Get file extensions
     blob_name = blob_input.get("name", "")
-    file_extension = blob_name.lower().split('.')[-1] if '.' in blob_name else ""
-    # Audio file extensions
-    audio_extensions = ['wav', 'mp3', 'opus', 'ogg', 'flac', 'wma', 'aac', 'webm']
-    # Document file extensions
-    document_extensions = ['pdf', 'docx', 'doc', 'xlsx', 'pptx', 'jpg', 'jpeg', 'png', 'tiff', 'bmp']
-    
-
-    # Define retry options for handling transient failures
-    # Note: backoff_coefficient requires azure-functions-durable >= 1.3.0
-    retry_options = RetryOptions(
-        first_retry_interval_in_milliseconds=5000,    # 5 seconds initial wait
-        max_number_of_attempts=5                       # More attempts for rate limit scenarios
-    )
+    file_extension = os.path.splitext(blob_name)[1].lower()
+    file_type = FILE_TYPES_BY_EXTENSION.get(file_extension)
 
     # 1. Process Data Source based on file type
-    if config.get_value("AOAI_MULTI_MODAL", "false").lower() == "true" and file_extension in document_extensions:
+    if AOAI_MULTI_MODAL and file_type == "document":
         aoai_input = {
             "name": blob_input.get("name"),
             "container": blob_input.get("container"),
@@ -143,21 +321,60 @@ def process_blob(context):
             "instance_id": sub_orchestration_id
         }
 
-        text_result = yield context.call_activity_with_retry("callAoaiMultiModal", retry_options, aoai_input)
+        text_result = yield context.call_activity_with_retry("callAoaiMultiModal", RETRY_OPTIONS, aoai_input)
 
 
-    elif config.get_value("AI_VISION_ENABLED", "false").lower() == "true":
+    elif AI_VISION_ENABLED:
         pass
 
-    elif file_extension in audio_extensions:
-        # Process audio with speech-to-text
+    elif file_type == "audio" and SPEECH_BATCHING_ENABLED:
+        # Queue the blob for the next batched transcription job
+        logging.info(f"Queueing audio file for batch transcription: {blob_name}")
+        context.signal_entity(PENDING_AUDIO_BATCH, "add", {
+            "name": blob_name,
+            "uri": blob_input.get("uri"),
+            "instance_id": sub_orchestration_id
+        })
+
+        completed = context.wait_for_external_event("stt_batch_done")
+        timeout = context.create_timer(context.current_utc_datetime + SPEECH_BATCH_TIMEOUT)
+        winner = yield context.task_any([completed, timeout])
+        if winner == completed:
+            timeout.cancel()
+            text_result = completed.result.get("text_result")
+        else:
+            text_result = None
+
+        if text_result is None:
+            logging.warning(f"No batched transcript for {blob_name}; transcribing it on its own")
+            text_result = yield context.call_activity_with_retry("speechToText", RETRY_OPTIONS, blob_input)
+
+    elif file_type == "audio" and SPEECH_CALLBACK_ENABLED:
+        # Process audio with speech-to-text, completion signaled by web hook
         logging.info(f"Processing audio file: {blob_name}")
-        text_result = yield context.call_activity_with_retry("speechToText", retry_options, blob_input)
-
-    elif file_extension in document_extensions:
-        # Process document with Document Intelligence
-        logging.info(f"Processing document file: {blob_name}")
-        text_result = yield context.call_activity_with_retry("runDocIntel", retry_options, blob_input)
+        # Submit, then sleep until the web hook raises stt_done instead of
+        # holding a worker in a poll loop
+        submit_input = {**blob_input, "instance_id": sub_orchestration_id}
+        transcription_url = yield context.call_activity_with_retry("submitTranscription", RETRY_OPTIONS, submit_input)
+
+        completed = context.wait_for_external_event("stt_done")
+        timeout = context.create_timer(context.current_utc_datetime + SPEECH_CALLBACK_TIMEOUT)
+        winner = yield context.task_any([completed, timeout])
+        if winner == completed:
+            timeout.cancel()
+        else:
+            logging.warning(f"No stt_done event for {blob_name}; polling transcription instead")
+
+        text_result = yield context.call_activity_with_retry(
+            "getTranscriptionText",
+            RETRY_OPTIONS,
+            {"transcription_url": transcription_url}
+        )
+
+    elif file_type is not None:
+        # Process audio with speech-to-text, documents with Document Intelligence
+        logging.info(f"Processing {file_type} file: {blob_name}")
+        text_result = yield context.call_activity_with_retry(TEXT_EXTRACTION_ACTIVITIES[file_type], RETRY_OPTIONS, blob_input)
         
     else:
         # Unsupported file type
@@ -175,13 +392,31 @@ def process_blob(context):
         "instance_id": sub_orchestration_id 
     }
 
-    aoai_output = yield context.call_activity_with_retry("callAoai", retry_options, call_aoai_input)
-    
+    aoai_task = context.call_activity_with_retry("callAoai", RETRY_OPTIONS, call_aoai_input)
+
+    text_task_result = None
+    if WRITE_TEXT_RESULT:
+        # Persist the extracted text alongside the AOAI call rather than after it
+        text_output_blob = f"{os.path.splitext(os.path.basename(blob_name))[0]}-text.txt"
+        write_text_task = context.call_activity_with_retry(
+            "writeToBlob",
+            RETRY_OPTIONS,
+            {
+                "json_str": text_result,
+                "blob_name": blob_input["name"],
+                "final_output_container": FINAL_OUTPUT_CONTAINER,
+                "output_blob": text_output_blob
+            }
+        )
+        aoai_output, text_task_result = yield context.task_all([aoai_task, write_text_task])
+    else:
+        aoai_output = yield aoai_task
+
 
     # 3. Write AOAI output to Blob Storage
     task_result = yield context.call_activity_with_retry(
         "writeToBlob", 
-        retry_options,
+        RETRY_OPTIONS,
         {
             "json_str": aoai_output, 
             "blob_name": blob_input["name"],
@@ -191,7 +426,8 @@ def process_blob(context):
     return {
         "blob": blob_input,
         "text_result": aoai_output,
-        "task_result": task_result
+        "task_result": task_result,
+        "text_task_result": text_task_result
     }   
 
 app.register_functions(runDocIntel.bp)
@@ -1,10 +1,9 @@
-from openai import AzureOpenAI
 import logging
 from azure.identity import get_bearer_token_provider
 from pipelineUtils.db import save_chat_message
-from configuration import Configuration
+from configuration import get_configuration
 
-config = Configuration()
+config = get_configuration()
 
 OPENAI_API_BASE = config.get_value("OPENAI_API_BASE")
 OPENAI_MODEL = config.get_value("OPENAI_MODEL")
@@ -12,6 +11,9 @@ OPENAI_API_VERSION = config.get_value("OPENAI_API_VERSION")
 
 
 def run_prompt(pipeline_id, system_prompt, user_prompt):
+    # Imported on first use so the OpenAI client does not load on every host cold start
+    from openai import AzureOpenAI
+
     token_provider = get_bearer_token_provider(  
         config.credential,  
         "https://cognitiveservices.azure.com/.default"  
@@ -6,8 +6,8 @@ import json
 from azure.identity import DefaultAzureCredential
 from azure.storage.blob import BlobServiceClient
 
-from configuration import Configuration
-config = Configuration()
+from configuration import get_configuration
+config = get_configuration()
 
 BLOB_ENDPOINT=config.get_value("DATA_STORAGE_ENDPOINT")
 
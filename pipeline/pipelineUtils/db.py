@@ -9,8 +9,8 @@ import uuid
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 
-from configuration import Configuration
-config = Configuration()
+from configuration import get_configuration
+config = get_configuration()
 
 # Retrieve Cosmos DB settings from environment variables
 COSMOS_DB_URI = config.get_value("COSMOS_DB_URI")
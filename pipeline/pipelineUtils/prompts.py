@@ -4,8 +4,8 @@ from pipelineUtils.blob_functions import get_blob_content
 import yaml
 import logging
 
-from configuration import Configuration
-config = Configuration()
+from configuration import get_configuration
+config = get_configuration()
 
 def load_prompts_from_blob(prompt_file):
     """Load the prompt from YAML file in blob storage and return as a dictionary."""